@@ -38,7 +38,8 @@ class PairedDataset(Dataset):
 
         return low_image, high_image
 
-def create_dataloaders(train_low, train_high, test_low, test_high, crop_size=256, batch_size=1):
+def create_dataloaders(train_low, train_high, test_low, test_high, crop_size=256, batch_size=1, test_batch_size=1,
+                       num_workers=4, pin_memory=False, persistent_workers=False):
     transform = transforms.Compose([
         transforms.ToTensor(),
         # transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))
@@ -48,10 +49,12 @@ def create_dataloaders(train_low, train_high, test_low, test_high, crop_size=256
     
     if train_low and train_high:
         train_dataset = PairedDataset(train_low, train_high, transform=transform, crop_size=crop_size, training=True)
-        train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True, num_workers=4)
+        train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=True, num_workers=num_workers,
+                                  pin_memory=pin_memory, persistent_workers=persistent_workers)
 
     if test_low and test_high:
         test_dataset = PairedDataset(test_low, test_high, transform=transform, training=False)
-        test_loader = DataLoader(test_dataset, batch_size=1, shuffle=False, num_workers=4)
+        test_loader = DataLoader(test_dataset, batch_size=test_batch_size, shuffle=False, num_workers=num_workers,
+                                 pin_memory=pin_memory, persistent_workers=persistent_workers)
 
     return train_loader, test_loader
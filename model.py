@@ -4,83 +4,129 @@ import torch.nn.functional as F
 import torch.nn.init as init
 # from einops import rearrange
 
+# 啟用 FlashAttention 與 memory-efficient SDPA 核心
+torch.backends.cuda.enable_flash_sdp(True)
+torch.backends.cuda.enable_mem_efficient_sdp(True)
+
 class MultiHeadSelfAttention(nn.Module):
-    def __init__(self, embed_size, num_heads):
+    def __init__(self, embed_size, num_heads, groups=1):
         super(MultiHeadSelfAttention, self).__init__()
         self.embed_size = embed_size
         self.num_heads = num_heads
+        # groups 個分支各自獨立做 attention (參數不共享、分支之間不混合)，embed_size 為每個分支的通道數
+        self.groups = groups
         assert embed_size % num_heads == 0
         self.head_dim = embed_size // num_heads
-        self.query_dense = nn.Linear(embed_size, embed_size)
-        self.key_dense = nn.Linear(embed_size, embed_size)
-        self.value_dense = nn.Linear(embed_size, embed_size)
-        self.combine_heads = nn.Linear(embed_size, embed_size)
+        # 將 query / key / value 投影合併為單一投影，每個分支一組 (out, in) 權重
+        self.qkv_weight = nn.Parameter(torch.empty(groups, 3 * embed_size, embed_size))
+        self.qkv_bias = nn.Parameter(torch.empty(groups, 3 * embed_size))
+        self.combine_heads_weight = nn.Parameter(torch.empty(groups, embed_size, embed_size))
+        self.combine_heads_bias = nn.Parameter(torch.empty(groups, embed_size))
+        # head_dim 很小時 FlashAttention 不一定比 math 路徑快，可由 GammaUnet.select_attention_path 實測決定。
+        # 注意：use_flash 是 Dynamo 會 guard 的 Python 屬性，編譯後切換它會觸發重新編譯。
+        self.use_flash = True
         self._init_weights()
 
-    def split_heads(self, x, batch_size):
-        x = x.reshape(batch_size, -1, self.num_heads, self.head_dim)
-        return x.permute(0, 2, 1, 3)
+    def _project(self, x, weight, bias):
+        # 分支各自的線性投影：x 為 (B, G, N, in)，weight 為 (G, out, in)
+        return torch.einsum('bgni,goi->bgno', x, weight) + bias.unsqueeze(1)
 
     def forward(self, x):
+        # 輸入為連續 (contiguous) 的 NCHW 張量，與原始模型相同直接 reshape 為 token 序列 (每個分支各自 reshape)
         batch_size, _, height, width = x.size()
-        x = x.reshape(batch_size, height * width, -1)
+        x = x.reshape(batch_size, self.groups, height * width, self.embed_size)
 
-        query = self.split_heads(self.query_dense(x), batch_size)
-        key = self.split_heads(self.key_dense(x), batch_size)
-        value = self.split_heads(self.value_dense(x), batch_size)
-        
-        attention_weights = F.softmax(torch.matmul(query, key.transpose(-2, -1)) / (self.head_dim ** 0.5), dim=-1)
-        attention = torch.matmul(attention_weights, value)
-        attention = attention.permute(0, 2, 1, 3).contiguous().reshape(batch_size, -1, self.embed_size)
-        
-        output = self.combine_heads(attention)
-        return output.reshape(batch_size, height, width, self.embed_size).permute(0, 3, 1, 2)
+        if height * width == 1:
+            # 只有單一 token 時 softmax 恆為 1，注意力輸出即為 value，只需計算 value 投影
+            value = self._project(x, self.qkv_weight[:, 2 * self.embed_size:], self.qkv_bias[:, 2 * self.embed_size:])
+            output = self._project(value, self.combine_heads_weight, self.combine_heads_bias)
+        else:
+            qkv = self._project(x, self.qkv_weight, self.qkv_bias)
+            qkv = qkv.reshape(batch_size * self.groups, -1, 3, self.num_heads, self.head_dim).permute(2, 0, 3, 1, 4)
+            query, key, value = qkv[0], qkv[1], qkv[2]
+
+            if self.use_flash:
+                # 使用融合的 scaled dot-product attention (不需實體化 N x N 的注意力矩陣)
+                attention = F.scaled_dot_product_attention(query, key, value, is_causal=False)
+            else:
+                attention_weights = F.softmax(torch.matmul(query, key.transpose(-2, -1)) / (self.head_dim ** 0.5), dim=-1)
+                attention = torch.matmul(attention_weights, value)
+            attention = attention.transpose(1, 2).reshape(batch_size, self.groups, -1, self.embed_size)
+
+            output = self._project(attention, self.combine_heads_weight, self.combine_heads_bias)
+        # 一次複製直接寫成 channels-last (NHWC) 配置，讓後續的上採樣路徑與卷積維持 channels-last
+        output = output.reshape(batch_size, self.groups, height, width, self.embed_size).permute(0, 2, 3, 1, 4)
+        return output.reshape(batch_size, height, width, self.groups * self.embed_size).permute(0, 3, 1, 2)
 
     def _init_weights(self):
-        init.xavier_uniform_(self.query_dense.weight)
-        init.xavier_uniform_(self.key_dense.weight)
-        init.xavier_uniform_(self.value_dense.weight)
-        init.xavier_uniform_(self.combine_heads.weight)
-        init.constant_(self.query_dense.bias, 0)
-        init.constant_(self.key_dense.bias, 0)
-        init.constant_(self.value_dense.bias, 0)
-        init.constant_(self.combine_heads.bias, 0)
+        # 對每個分支的 q, k, v 三段權重分別做 xavier 初始化，與分開的 Linear 相同
+        for group in range(self.groups):
+            for weight in self.qkv_weight.data[group].chunk(3, dim=0):
+                init.xavier_uniform_(weight)
+            init.xavier_uniform_(self.combine_heads_weight.data[group])
+        init.constant_(self.qkv_bias, 0)
+        init.constant_(self.combine_heads_bias, 0)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # 單一分支的舊版 (nn.Linear) 權重轉換為 groups=1 的分支權重
+        _migrate_qkv_state_dict(state_dict, prefix)
+        for linear_name, name in _GROUPED_ATTENTION_PARAMS.items():
+            if prefix + linear_name in state_dict:
+                state_dict[prefix + name] = state_dict.pop(prefix + linear_name).unsqueeze(0)
+        super(MultiHeadSelfAttention, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+# 舊版 nn.Linear 參數名稱與分支權重參數名稱的對應
+_GROUPED_ATTENTION_PARAMS = {
+    'qkv.weight': 'qkv_weight',
+    'qkv.bias': 'qkv_bias',
+    'combine_heads.weight': 'combine_heads_weight',
+    'combine_heads.bias': 'combine_heads_bias',
+}
+
+def _migrate_qkv_state_dict(state_dict, prefix):
+    # 將舊版分開的 query_dense / key_dense / value_dense 權重合併為 qkv，以載入舊的 checkpoint
+    names = ['query_dense', 'key_dense', 'value_dense']
+    if prefix + 'query_dense.weight' not in state_dict:
+        return
+    for param in ['weight', 'bias']:
+        tensors = [state_dict.pop(f'{prefix}{name}.{param}') for name in names]
+        state_dict[f'{prefix}qkv.{param}'] = torch.cat(tensors, dim=0)
 
 class Denoiser(nn.Module):
-    def __init__(self, num_filters, kernel_size=3, activation='relu'):
+    def __init__(self, num_filters, kernel_size=3, activation='relu', groups=1):
         super(Denoiser, self).__init__()
+        # groups 個分支以分組卷積 (groups=groups) 合併為單一模組，每組 num_filters 個濾波器
+        channels = groups * num_filters
         # 定義卷積層
-        self.conv1 = nn.Conv2d(1, num_filters, kernel_size=kernel_size, padding=1)
-        self.conv2 = nn.Conv2d(num_filters, num_filters, kernel_size=kernel_size, stride=2, padding=1)
-        self.conv3 = nn.Conv2d(num_filters, num_filters, kernel_size=kernel_size, stride=2, padding=1)
-        self.conv4 = nn.Conv2d(num_filters, num_filters, kernel_size=kernel_size, stride=2, padding=1)
-        # 加入 MultiHeadSelfAttention
-        self.bottleneck = MultiHeadSelfAttention(embed_size=num_filters, num_heads=4)
-        # 上採樣層
-        self.up2 = nn.Upsample(scale_factor=2, mode='nearest')
-        self.up3 = nn.Upsample(scale_factor=2, mode='nearest')
-        self.up4 = nn.Upsample(scale_factor=2, mode='nearest')
+        self.conv1 = nn.Conv2d(groups, channels, kernel_size=kernel_size, padding=1, groups=groups)
+        self.conv2 = nn.Conv2d(channels, channels, kernel_size=kernel_size, stride=2, padding=1, groups=groups)
+        self.conv3 = nn.Conv2d(channels, channels, kernel_size=kernel_size, stride=2, padding=1, groups=groups)
+        self.conv4 = nn.Conv2d(channels, channels, kernel_size=kernel_size, stride=2, padding=1, groups=groups)
+        # 加入 MultiHeadSelfAttention (每個分支各自 4 個 head，分支之間互不混合)
+        self.bottleneck = MultiHeadSelfAttention(embed_size=num_filters, num_heads=4, groups=groups)
         # 輸出層與殘差層
-        self.output_layer = nn.Conv2d(1, 1, kernel_size=kernel_size, padding=1)
-        self.res_layer = nn.Conv2d(num_filters, 1, kernel_size=kernel_size, padding=1)
+        self.output_layer = nn.Conv2d(groups, groups, kernel_size=kernel_size, padding=1, groups=groups)
+        self.res_layer = nn.Conv2d(channels, groups, kernel_size=kernel_size, padding=1, groups=groups)
         self.activation = getattr(F, activation)
         self._init_weights()
+        # 卷積權重使用 channels-last (NHWC) 記憶體配置 (僅限卷積路徑)
+        self.to(memory_format=torch.channels_last)
 
     def forward(self, x):
+        x = x.contiguous(memory_format=torch.channels_last)
         # 下採樣路徑
         x1 = self.activation(self.conv1(x))
         x2 = self.activation(self.conv2(x1))
         x3 = self.activation(self.conv3(x2))
         x4 = self.activation(self.conv4(x3))
-        # 通過 MultiHeadSelfAttention
-        x = self.bottleneck(x4)
-        # 上採樣路徑與跳躍連接
-        x = self.up4(x)
-        x = self.up3(x + x3)
-        x = self.up2(x + x2)
-        x = x + x1
+        # 通過 MultiHeadSelfAttention (token 順序依 NCHW 記憶體配置而定，需轉回 contiguous 以符合已訓練的權重)
+        x = self.bottleneck(x4.contiguous())
+        # 上採樣路徑與跳躍連接 (bottleneck 輸出為 channels-last，直接在上採樣結果上就地加上跳躍連接)
+        x = F.interpolate(x, scale_factor=2, mode='nearest').add_(x3)
+        x = F.interpolate(x, scale_factor=2, mode='nearest').add_(x2)
+        x = F.interpolate(x, scale_factor=2, mode='nearest').add_(x1)
         x = self.res_layer(x)
-        return torch.tanh(self.output_layer(x + x))
+        return torch.tanh(self.output_layer(x))
     
     def _init_weights(self):
         for layer in [self.conv1, self.conv2, self.conv3, self.conv4, self.output_layer, self.res_layer]:
@@ -89,12 +135,12 @@ class Denoiser(nn.Module):
                 init.constant_(layer.bias, 0)
 
 class GammaUnet(nn.Module):
-    def __init__(self, num_filters=32):
+    def __init__(self, num_filters=32, fp16_color=False):
         super(GammaUnet, self).__init__()
-        # 為每個分支定義 Denoiser 模組（包含 MultiHeadSelfAttention）
-        self.denoiser_y = Denoiser(num_filters)
-        self.denoiser_cb = Denoiser(num_filters)
-        self.denoiser_cr = Denoiser(num_filters)
+        # 在 CUDA 上以 FP16 進行色彩轉換 (僅供推論端明確選用，不隨 train/eval 模式自動切換)
+        self.fp16_color = fp16_color
+        # 以單一分組卷積 Denoiser 同時處理 Y, Cb, Cr 三個分支（包含 MultiHeadSelfAttention）
+        self.denoiser = Denoiser(num_filters, groups=3)
         
         
         # self.y_conv = nn.Conv2d(1, 1, kernel_size=3, padding=1)
@@ -104,62 +150,62 @@ class GammaUnet(nn.Module):
         self.final_conv = nn.Conv2d(3, 3, kernel_size=3, padding=1)
         
         self.gamma = 0.4  # Gamma 校正參數
+
+        # 色彩轉換矩陣 (不存入 state_dict，以相容既有的 checkpoint)
+        self.register_buffer('ycbcr_M', torch.tensor([
+            [0.299, 0.587, 0.114],
+            [-0.14713, -0.28886, 0.436],
+            [0.615, -0.51499, -0.10001],
+        ]), persistent=False)
+        self.register_buffer('ycbcr_bias', torch.tensor([0.0, 0.5, 0.5]), persistent=False)
+        self.register_buffer('oklab_M1', torch.tensor([
+            [0.4122214708, 0.5363325363, 0.0514459929],
+            [0.2119034982, 0.6806995451, 0.1073969566],
+            [0.0883024619, 0.2817188376, 0.6299787005],
+        ]), persistent=False)
+        self.register_buffer('oklab_M2', torch.tensor([
+            [0.2104542553, 0.7936177850, -0.0040720468],
+            [1.9779984951, -2.4285922050, 0.4505937099],
+            [0.0259040371, 0.7827717662, -0.8086757660],
+        ]), persistent=False)
         self._init_weights()
 
     def _rgb_to_ycbcr(self, image):
-        # 將 RGB 轉換為 YCbCr
-        r, g, b = image[:, 0, :, :], image[:, 1, :, :], image[:, 2, :, :]
-        y = 0.299 * r + 0.587 * g + 0.114 * b
-        cb = -0.14713 * r - 0.28886 * g + 0.436 * b + 0.5
-        cr = 0.615 * r - 0.51499 * g - 0.10001 * b + 0.5
-        return torch.stack([y, cb, cr], dim=1)
+        # 將 RGB 轉換為 YCbCr (單一 3x3 矩陣乘法加上偏移)
+        return torch.einsum('cd,bdhw->bchw', self.ycbcr_M.to(image.dtype), image) + self.ycbcr_bias.to(image.dtype).view(1, 3, 1, 1)
     
     def _rgb_to_oklab(self, image):
-        # 分離 r, g, b 通道
-        r, g, b = image[:, 0, :, :], image[:, 1, :, :], image[:, 2, :, :]
-        
         # 將線性 sRGB 轉換至中間表徵 l, m, s
-        l = 0.4122214708 * r + 0.5363325363 * g + 0.0514459929 * b
-        m = 0.2119034982 * r + 0.6806995451 * g + 0.1073969566 * b
-        s = 0.0883024619 * r + 0.2817188376 * g + 0.6299787005 * b
+        lms = torch.einsum('cd,bdhw->bchw', self.oklab_M1.to(image.dtype), image)
         
         # 分別取立方根 (使用 torch.sign 來正確處理正負值)
         eps = 1e-6
-        l_ = torch.sign(l) * (torch.abs(l) + eps).pow(1/3)
-        m_ = torch.sign(m) * (torch.abs(m) + eps).pow(1/3)
-        s_ = torch.sign(s) * (torch.abs(s) + eps).pow(1/3)
-        
-        # 計算 Oklab 各通道
-        L = 0.2104542553 * l_ + 0.7936177850 * m_ - 0.0040720468 * s_
-        a = 1.9779984951 * l_ - 2.4285922050 * m_ + 0.4505937099 * s_
-        b_out = 0.0259040371 * l_ + 0.7827717662 * m_ - 0.8086757660 * s_
+        lms_ = lms.sign() * (lms.abs() + eps).pow_(1/3)
         
-        # 合併 L, a, b 三個通道
-        oklab = torch.stack((L, a, b_out), dim=1)
+        # 計算 Oklab 各通道 (L, a, b)
+        oklab = torch.einsum('cd,bdhw->bchw', self.oklab_M2.to(image.dtype), lms_)
         return oklab
     
     def _gamma_correction(self, image, gamma):
-        # 確保輸入在 [0, 1] 範圍內，並添加數值穩定性
+        # 確保輸入在 [eps, 1] 範圍內，並添加數值穩定性
         eps = 1e-8  # 避免零值問題
-        image = torch.clamp(image, 0, 1)  # 限制範圍
-        return torch.pow(image + eps, gamma)
+        image = torch.clamp(image, eps, 1)  # 限制範圍 (產生新的張量，後續可安全就地運算)
+        # x^gamma = exp(gamma * log(x))，就地運算重複使用同一塊緩衝區
+        return image.log_().mul_(gamma).exp_()
 
     def forward(self, x):
         # 將 RGB 轉換為 YCbCr
-        ycbcr = self._rgb_to_oklab(x)
-        y, cb, cr = torch.split(ycbcr, 1, dim=1)
+        if self.fp16_color and x.is_cuda:
+            # 以 FP16 進行色彩轉換 (記憶體頻寬受限的運算)，Gamma 校正前轉回 FP32
+            ycbcr = self._rgb_to_oklab(x.half()).float()
+        else:
+            ycbcr = self._rgb_to_oklab(x)
 
         # 對 Y 和 Cb 分支進行 Gamma 校正
-        y = self._gamma_correction(y, self.gamma)
-        cb = self._gamma_correction(cb, self.gamma)
+        ycbcr = torch.cat([self._gamma_correction(ycbcr[:, :2], self.gamma), ycbcr[:, 2:]], dim=1)
 
-        # 對每個分支進行去噪處理
-        y_denoised = self.denoiser_y(y)
-        cb_denoised = self.denoiser_cb(cb)
-        cr_denoised = self.denoiser_cr(cr)
-
-        # # 將處理後的三個分支合併
-        combined = torch.cat([y_denoised, cb_denoised, cr_denoised], dim=1)
+        # 以分組卷積一次對三個分支進行去噪處理，輸出即為合併後的三個分支
+        combined = self.denoiser(ycbcr)
 
         # # 通過最終的 3x3 卷積層
         output = self.final_conv(combined)
@@ -178,4 +224,55 @@ class GammaUnet(nn.Module):
     def _init_weights(self):
         init.kaiming_uniform_(self.final_conv.weight, a=0, mode='fan_in', nonlinearity='relu')
         if self.final_conv.bias is not None:
-            init.constant_(self.final_conv.bias, 0)
\ No newline at end of file
+            init.constant_(self.final_conv.bias, 0)
+
+    def select_attention_path(self, x, iters=20):
+        # 以代表性的輸入影像實測整個模型在 SDPA 與 math 兩種 attention 路徑下的速度，保留較快者 (僅限 CUDA)。
+        # 量測的是 self(x)，若已呼叫 model.compile() 即為編譯後的路徑 (Inductor 可能融合 math 路徑)，
+        # 但不包含 CUDA graph replay。每次切換 use_flash 都會觸發 Dynamo 重新編譯，因此每個路徑先暖機兩次。
+        bottleneck = self.denoiser.bottleneck
+        if not x.is_cuda:
+            return bottleneck.use_flash
+        timings = {}
+        with torch.inference_mode():
+            for use_flash in [True, False]:
+                bottleneck.use_flash = use_flash
+                for _ in range(2):
+                    self(x)  # 暖機 (含編譯)
+                start = torch.cuda.Event(enable_timing=True)
+                end = torch.cuda.Event(enable_timing=True)
+                start.record()
+                for _ in range(iters):
+                    self(x)
+                end.record()
+                torch.cuda.synchronize()
+                timings[use_flash] = start.elapsed_time(end)
+        bottleneck.use_flash = timings[True] <= timings[False]
+        return bottleneck.use_flash
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        _migrate_branch_state_dict(state_dict, prefix)
+        super(GammaUnet, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+def _migrate_branch_state_dict(state_dict, prefix):
+    # 將舊版三個獨立的 denoiser_y / denoiser_cb / denoiser_cr 權重合併為分組卷積的 denoiser
+    branches = [f'{prefix}denoiser_{name}.' for name in ['y', 'cb', 'cr']]
+    if branches[0] + 'conv1.weight' not in state_dict:
+        return
+    for branch in branches:
+        _migrate_qkv_state_dict(state_dict, branch + 'bottleneck.')
+    suffixes = [key[len(branches[0]):] for key in list(state_dict) if key.startswith(branches[0])]
+    for suffix in suffixes:
+        tensors = [state_dict.pop(branch + suffix) for branch in branches]
+        module, _, name = suffix.partition('.')
+        if module == 'bottleneck' and name in _GROUPED_ATTENTION_PARAMS:
+            # attention 投影依分支堆疊為 (G, ...) 的分支權重
+            suffix = 'bottleneck.' + _GROUPED_ATTENTION_PARAMS[name]
+            merged = torch.stack(tensors, dim=0)
+        else:
+            # 卷積權重與偏差沿輸出通道串接即為分組卷積的參數
+            merged = torch.cat(tensors, dim=0)
+        if suffix == 'output_layer.weight':
+            # 舊版計算 output_layer(x + x) == (2W) * x + b，將權重加倍以保持輸出不變
+            merged = merged * 2
+        state_dict[f'{prefix}denoiser.{suffix}'] = merged
@@ -8,6 +8,22 @@ import numpy as np
 from torchvision.utils import save_image
 import lpips
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+def _gt_mean_match(img1, img2):
+    """
+    Scale img1 so that its mean brightness matches img2 (GT-mean evaluation).
+
+    Args:
+        img1 (torch.Tensor): Restored image (BxCxHxW)
+        img2 (torch.Tensor): Target image (BxCxHxW)
+
+    Returns:
+        torch.Tensor: The brightness-matched img1, clamped to [0, 1].
+    """
+    mean_restored = img1.mean(dim=(1, 2, 3), keepdim=True)
+    mean_target = img2.mean(dim=(1, 2, 3), keepdim=True)
+    return (img1 * (mean_target / mean_restored)).clamp_(0, 1)
 
 def calculate_psnr(img1, img2, max_pixel_value=1.0, gt_mean=True):
     """
@@ -22,12 +38,7 @@ def calculate_psnr(img1, img2, max_pixel_value=1.0, gt_mean=True):
         float: The PSNR value.
     """
     if gt_mean:
-        img1_gray = img1.mean(axis=1)
-        img2_gray = img2.mean(axis=1)
-        
-        mean_restored = img1_gray.mean()
-        mean_target = img2_gray.mean()
-        img1 = torch.clamp(img1 * (mean_target / mean_restored), 0, 1)
+        img1 = _gt_mean_match(img1, img2)
     
     mse = F.mse_loss(img1, img2, reduction='mean')
     if mse == 0:
@@ -48,46 +59,92 @@ def calculate_ssim(img1, img2, max_pixel_value=1.0, gt_mean=True):
         float: The SSIM value.
     """
     if gt_mean:
-        img1_gray = img1.mean(axis=1, keepdim=True)
-        img2_gray = img2.mean(axis=1, keepdim=True)
-        
-        mean_restored = img1_gray.mean()
-        mean_target = img2_gray.mean()
-        img1 = torch.clamp(img1 * (mean_target / mean_restored), 0, 1)
+        img1 = _gt_mean_match(img1, img2)
 
     ssim_val = structural_similarity_index_measure(img1, img2, data_range=max_pixel_value)
     return ssim_val.item()
 
-def validate(model, dataloader, device, result_dir):
+def _capture_cuda_graph(model, example, warmup_iters=3):
+    """
+    Capture one forward pass of the model as a CUDA graph.
+
+    Args:
+        model (torch.nn.Module): The model, already in eval mode.
+        example (torch.Tensor): Input with the shape to capture (BxCxHxW)
+        warmup_iters (int): Forward passes to run on a side stream before capture. Default is 3.
+
+    Returns:
+        tuple: The graph, its static input and its static output.
+    """
+    static_input = example.clone()
+    stream = torch.cuda.Stream()
+    stream.wait_stream(torch.cuda.current_stream())
+    with torch.cuda.stream(stream):
+        for _ in range(warmup_iters):
+            model(static_input)
+    torch.cuda.current_stream().wait_stream(stream)
+
+    graph = torch.cuda.CUDAGraph()
+    with torch.cuda.graph(graph):
+        static_output = model(static_input)
+    return graph, static_input, static_output
+
+def validate(model, dataloader, device, result_dir, loss_fn):
     model.eval()
     total_psnr = 0
     total_ssim = 0
     total_lpips = 0
-    loss_fn = lpips.LPIPS(net='alex').to(device)
-    with torch.no_grad():
-        for idx, (low, high) in enumerate(dataloader):
-            low, high = low.to(device), high.to(device)
-            output = model(low)
-            output = torch.clamp(output, 0, 1)
-
-            # Save the output image
-            save_image(output, os.path.join(result_dir, f'result_{idx}.png'))
-
-            # Calculate PSNR
-            psnr = calculate_psnr(output, high)
-            total_psnr += psnr
-
-            # Calculate SSIM
-            ssim = calculate_ssim(output, high)
-            total_ssim += ssim
+    num_samples = 0
+    futures = []
+    # One CUDA graph per input shape (the last batch may be smaller)
+    graphs = {}
+    # PNG encoding and disk writes run in background threads. Leaving the with-block
+    # waits for pending writes and shuts the pool down, even if the loop raises.
+    with ThreadPoolExecutor(max_workers=4) as pool, torch.inference_mode():
+        for low, high in dataloader:
+            low, high = low.to(device, non_blocking=True), high.to(device, non_blocking=True)
+            # Run the model in FP16 on CUDA, metrics are computed in FP32.
+            # The autocast cache must be disabled for CUDA graph capture.
+            with torch.autocast(device_type=device.type, dtype=torch.float16, enabled=device.type == 'cuda',
+                                cache_enabled=False):
+                if device.type == 'cuda':
+                    key = tuple(low.shape)
+                    if key not in graphs:
+                        graphs[key] = _capture_cuda_graph(model, low)
+                    graph, static_input, static_output = graphs[key]
+                    static_input.copy_(low)
+                    graph.replay()
+                    output = static_output
+                else:
+                    output = model(low)
+            # clamp writes a new tensor, so the graph's static output is not reused below
+            output = torch.clamp(output.float(), 0, 1)
+
+            # Copy to the CPU (blocking), then encode and write the PNGs in background threads
+            for i, image in enumerate(output.cpu().unbind(0)):
+                futures.append(pool.submit(save_image, image, os.path.join(result_dir, f'result_{num_samples + i}.png')))
+
+            # Match the output brightness to the target once for both metrics
+            output_matched = _gt_mean_match(output, high)
+
+            # PSNR and SSIM are computed per sample
+            for i in range(output.size(0)):
+                total_psnr += calculate_psnr(output_matched[i:i + 1], high[i:i + 1], gt_mean=False)
+                total_ssim += calculate_ssim(output_matched[i:i + 1], high[i:i + 1], gt_mean=False)
 
             # Calculate LPIPS
             lpips_score = loss_fn.forward(high, output)
-            total_lpips += lpips_score.item()
+            total_lpips += lpips_score.sum().item()
+
+            num_samples += output.size(0)
 
-    avg_psnr = total_psnr / len(dataloader)
-    avg_ssim = total_ssim / len(dataloader)
-    avg_lpips = total_lpips / len(dataloader)
+    # Surface any write errors
+    for future in futures:
+        future.result()
+
+    avg_psnr = total_psnr / num_samples
+    avg_ssim = total_ssim / num_samples
+    avg_lpips = total_lpips / num_samples
     return avg_psnr, avg_ssim, avg_lpips
 
 def main():
@@ -100,14 +157,32 @@ def main():
     dataset_name = test_low.split('/')[1]
     result_dir = '/content/drive/MyDrive/Gamma-Unet/results/testing/output'
 
-    _, test_loader = create_dataloaders(None, None, test_low, test_high, crop_size=None, batch_size=1)
+    _, test_loader = create_dataloaders(None, None, test_low, test_high, crop_size=None, test_batch_size=8,
+                                        num_workers=4, pin_memory=True, persistent_workers=True)
     print(f'Test loader: {len(test_loader)}')
 
-    model = GammaUnet().to(device)
+    model = GammaUnet(fp16_color=True).to(device)
     model.load_state_dict(torch.load(weights_path, map_location=device))
     print(f'Model loaded from {weights_path}')
-
-    avg_psnr, avg_ssim, avg_lpips = validate(model, test_loader, device, result_dir)
+    # Compile the whole model once after loading the weights. This is the only torch.compile in the
+    # repo: Inductor fuses the conv + relu epilogues and the attention bottleneck, and uses the default
+    # mode (no internal CUDA graphs) so validate can capture its own CUDA graph around it.
+    model.compile()
+    # Warm up with a representative batch so compilation for the test shape happens before evaluation
+    low, _ = next(iter(test_loader))
+    with torch.inference_mode(), torch.autocast(device_type=device.type, dtype=torch.float16,
+                                                enabled=device.type == 'cuda'):
+        model(low.to(device))
+    # head_dim is small (8), so time the compiled model with SDPA and with the plain matmul
+    # attention and keep the faster one (CUDA graph replay in validate is not included)
+    if device.type == 'cuda':
+        with torch.autocast(device_type=device.type, dtype=torch.float16):
+            use_flash = model.select_attention_path(low.to(device))
+        print(f'Attention path: {"SDPA" if use_flash else "math"}')
+
+    loss_fn = lpips.LPIPS(net='alex').to(device).eval()
+
+    avg_psnr, avg_ssim, avg_lpips = validate(model, test_loader, device, result_dir, loss_fn)
     print(f'Validation PSNR: {avg_psnr:.6f}, SSIM: {avg_ssim:.6f}, LPIPS: {avg_lpips:.6f}')
 
     # write log
@@ -14,6 +14,21 @@ import numpy as np
 import lpips
 from datetime import datetime
 
+def _gt_mean_match(img1, img2):
+    """
+    Scale img1 so that its mean brightness matches img2 (GT-mean evaluation).
+
+    Args:
+        img1 (torch.Tensor): Restored image (BxCxHxW)
+        img2 (torch.Tensor): Target image (BxCxHxW)
+
+    Returns:
+        torch.Tensor: The brightness-matched img1, clamped to [0, 1].
+    """
+    mean_restored = img1.mean(dim=(1, 2, 3), keepdim=True)
+    mean_target = img2.mean(dim=(1, 2, 3), keepdim=True)
+    return (img1 * (mean_target / mean_restored)).clamp_(0, 1)
+
 def calculate_psnr(img1, img2, max_pixel_value=1.0, gt_mean=True):
     """
     Calculate PSNR (Peak Signal-to-Noise Ratio) between two images.
@@ -27,12 +42,7 @@ def calculate_psnr(img1, img2, max_pixel_value=1.0, gt_mean=True):
         float: The PSNR value.
     """
     if gt_mean:
-        img1_gray = img1.mean(axis=1)
-        img2_gray = img2.mean(axis=1)
-        
-        mean_restored = img1_gray.mean()
-        mean_target = img2_gray.mean()
-        img1 = torch.clamp(img1 * (mean_target / mean_restored), 0, 1)
+        img1 = _gt_mean_match(img1, img2)
     
     mse = F.mse_loss(img1, img2, reduction='mean')
     if mse == 0:
@@ -53,12 +63,7 @@ def calculate_ssim(img1, img2, max_pixel_value=1.0, gt_mean=True):
         float: The SSIM value.
     """
     if gt_mean:
-        img1_gray = img1.mean(axis=1, keepdim=True)
-        img2_gray = img2.mean(axis=1, keepdim=True)
-        
-        mean_restored = img1_gray.mean()
-        mean_target = img2_gray.mean()
-        img1 = torch.clamp(img1 * (mean_target / mean_restored), 0, 1)
+        img1 = _gt_mean_match(img1, img2)
 
     ssim_val = structural_similarity_index_measure(img1, img2, data_range=max_pixel_value)
     return ssim_val.item()
@@ -70,7 +75,7 @@ def validate(model, dataloader, device, result_dir):
     total_lpips = 0
     loss_fn = lpips.LPIPS(net='alex').to(device)
 
-    with torch.no_grad():
+    with torch.inference_mode():
         for idx, (low, high) in enumerate(dataloader):
             low, high = low.to(device), high.to(device)
             output = model(low)
@@ -78,12 +83,15 @@ def validate(model, dataloader, device, result_dir):
             # Save the output image
             save_image(output, os.path.join(result_dir, f'result_{idx}.png'))
 
+            # Match the output brightness to the target once for both metrics
+            output_matched = _gt_mean_match(output, high)
+
             # Calculate PSNR
-            psnr = calculate_psnr(output, high)
+            psnr = calculate_psnr(output_matched, high, gt_mean=False)
             total_psnr += psnr
 
             # Calculate SSIM
-            ssim = calculate_ssim(output, high)
+            ssim = calculate_ssim(output_matched, high, gt_mean=False)
             total_ssim += ssim
 
             # Calculate LPIPS
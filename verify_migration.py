@@ -0,0 +1,151 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from model import MultiHeadSelfAttention, GammaUnet
+
+# Reference copies of the original (baseline) modules, used only to check that
+# baseline checkpoints load into the current model and give the same outputs.
+
+class BaselineMultiHeadSelfAttention(nn.Module):
+    def __init__(self, embed_size, num_heads):
+        super(BaselineMultiHeadSelfAttention, self).__init__()
+        self.embed_size = embed_size
+        self.num_heads = num_heads
+        self.head_dim = embed_size // num_heads
+        self.query_dense = nn.Linear(embed_size, embed_size)
+        self.key_dense = nn.Linear(embed_size, embed_size)
+        self.value_dense = nn.Linear(embed_size, embed_size)
+        self.combine_heads = nn.Linear(embed_size, embed_size)
+
+    def split_heads(self, x, batch_size):
+        x = x.reshape(batch_size, -1, self.num_heads, self.head_dim)
+        return x.permute(0, 2, 1, 3)
+
+    def forward(self, x):
+        batch_size, _, height, width = x.size()
+        x = x.reshape(batch_size, height * width, -1)
+
+        query = self.split_heads(self.query_dense(x), batch_size)
+        key = self.split_heads(self.key_dense(x), batch_size)
+        value = self.split_heads(self.value_dense(x), batch_size)
+
+        attention_weights = F.softmax(torch.matmul(query, key.transpose(-2, -1)) / (self.head_dim ** 0.5), dim=-1)
+        attention = torch.matmul(attention_weights, value)
+        attention = attention.permute(0, 2, 1, 3).contiguous().reshape(batch_size, -1, self.embed_size)
+
+        output = self.combine_heads(attention)
+        return output.reshape(batch_size, height, width, self.embed_size).permute(0, 3, 1, 2)
+
+class BaselineDenoiser(nn.Module):
+    def __init__(self, num_filters, kernel_size=3):
+        super(BaselineDenoiser, self).__init__()
+        self.conv1 = nn.Conv2d(1, num_filters, kernel_size=kernel_size, padding=1)
+        self.conv2 = nn.Conv2d(num_filters, num_filters, kernel_size=kernel_size, stride=2, padding=1)
+        self.conv3 = nn.Conv2d(num_filters, num_filters, kernel_size=kernel_size, stride=2, padding=1)
+        self.conv4 = nn.Conv2d(num_filters, num_filters, kernel_size=kernel_size, stride=2, padding=1)
+        self.bottleneck = BaselineMultiHeadSelfAttention(embed_size=num_filters, num_heads=4)
+        self.up2 = nn.Upsample(scale_factor=2, mode='nearest')
+        self.up3 = nn.Upsample(scale_factor=2, mode='nearest')
+        self.up4 = nn.Upsample(scale_factor=2, mode='nearest')
+        self.output_layer = nn.Conv2d(1, 1, kernel_size=kernel_size, padding=1)
+        self.res_layer = nn.Conv2d(num_filters, 1, kernel_size=kernel_size, padding=1)
+
+    def forward(self, x):
+        x1 = F.relu(self.conv1(x))
+        x2 = F.relu(self.conv2(x1))
+        x3 = F.relu(self.conv3(x2))
+        x4 = F.relu(self.conv4(x3))
+        x = self.bottleneck(x4)
+        x = self.up4(x)
+        x = self.up3(x + x3)
+        x = self.up2(x + x2)
+        x = x + x1
+        x = self.res_layer(x)
+        return torch.tanh(self.output_layer(x + x))
+
+class BaselineGammaUnet(nn.Module):
+    def __init__(self, num_filters=32):
+        super(BaselineGammaUnet, self).__init__()
+        self.denoiser_y = BaselineDenoiser(num_filters)
+        self.denoiser_cb = BaselineDenoiser(num_filters)
+        self.denoiser_cr = BaselineDenoiser(num_filters)
+        self.final_conv = nn.Conv2d(3, 3, kernel_size=3, padding=1)
+        self.gamma = 0.4
+
+    def _rgb_to_oklab(self, image):
+        r, g, b = image[:, 0, :, :], image[:, 1, :, :], image[:, 2, :, :]
+        l = 0.4122214708 * r + 0.5363325363 * g + 0.0514459929 * b
+        m = 0.2119034982 * r + 0.6806995451 * g + 0.1073969566 * b
+        s = 0.0883024619 * r + 0.2817188376 * g + 0.6299787005 * b
+        eps = 1e-6
+        l_ = torch.sign(l) * (torch.abs(l) + eps).pow(1/3)
+        m_ = torch.sign(m) * (torch.abs(m) + eps).pow(1/3)
+        s_ = torch.sign(s) * (torch.abs(s) + eps).pow(1/3)
+        L = 0.2104542553 * l_ + 0.7936177850 * m_ - 0.0040720468 * s_
+        a = 1.9779984951 * l_ - 2.4285922050 * m_ + 0.4505937099 * s_
+        b_out = 0.0259040371 * l_ + 0.7827717662 * m_ - 0.8086757660 * s_
+        return torch.stack((L, a, b_out), dim=1)
+
+    def _gamma_correction(self, image, gamma):
+        eps = 1e-8
+        image = torch.clamp(image, 0, 1)
+        return torch.pow(image + eps, gamma)
+
+    def forward(self, x):
+        ycbcr = self._rgb_to_oklab(x)
+        y, cb, cr = torch.split(ycbcr, 1, dim=1)
+        y = self._gamma_correction(y, self.gamma)
+        cb = self._gamma_correction(cb, self.gamma)
+        combined = torch.cat([self.denoiser_y(y), self.denoiser_cb(cb), self.denoiser_cr(cr)], dim=1)
+        return torch.sigmoid(self.final_conv(combined))
+
+def _randomize(module):
+    # Random weights and biases, so every migrated parameter affects the output
+    with torch.no_grad():
+        for param in module.parameters():
+            param.normal_(0, 0.1)
+    return module
+
+def check_attention():
+    baseline = _randomize(BaselineMultiHeadSelfAttention(32, 4)).eval()
+    model = MultiHeadSelfAttention(32, 4)
+    model.load_state_dict(baseline.state_dict())
+    model.eval()
+    with torch.no_grad():
+        for shape in [(2, 32, 6, 9), (2, 32, 1, 1)]:
+            x = torch.randn(shape)
+            for use_flash in [True, False]:
+                model.use_flash = use_flash
+                torch.testing.assert_close(model(x), baseline(x), rtol=1e-5, atol=1e-5)
+
+def check_model():
+    baseline = _randomize(BaselineGammaUnet()).eval()
+    # Plain dict copies drop _metadata, e.g. when stripping a DataParallel 'module.' prefix
+    for state_dict in [baseline.state_dict(), dict(baseline.state_dict())]:
+        model = GammaUnet()
+        model.load_state_dict(state_dict)
+        model.eval()
+        with torch.no_grad():
+            for shape in [(2, 3, 64, 96), (1, 3, 8, 8)]:
+                x = torch.rand(shape)
+                torch.testing.assert_close(model(x), baseline(x), rtol=1e-5, atol=1e-5)
+
+def check_reload():
+    # A current-format state dict must load unchanged, with or without _metadata
+    model = _randomize(GammaUnet()).eval()
+    x = torch.rand(2, 3, 64, 96)
+    for state_dict in [model.state_dict(), dict(model.state_dict())]:
+        reloaded = GammaUnet()
+        reloaded.load_state_dict(state_dict)
+        reloaded.eval()
+        with torch.no_grad():
+            torch.testing.assert_close(reloaded(x), model(x), rtol=0, atol=0)
+
+if __name__ == '__main__':
+    torch.manual_seed(0)
+    check_attention()
+    print('MultiHeadSelfAttention: baseline checkpoint matches')
+    check_model()
+    print('GammaUnet: baseline checkpoint matches')
+    check_reload()
+    print('GammaUnet: current checkpoint reloads unchanged')